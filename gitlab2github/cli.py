@@ -10,7 +10,9 @@ from .gitlab2github import github2gitlab
 @click.option('-glr', '--gitlab-repo', 'gitlab_repo', envvar='GITLAB_REPO', required=True, help='GitLab repository name with namespace.')
 @click.option('-ght', '--github-token', 'github_access_token', envvar='GITHUB_TOKEN', required=True, help='GitHub access token.')
 @click.option('-glt', '--gitlab-token', 'gitlab_access_token', envvar='GITLAB_TOKEN', required=False, help='GitLab access token.')
-def cli(github_repo, gitlab_repo, github_access_token, gitlab_access_token):
+@click.option('-w', '--workers', 'workers', envvar='WORKERS', default=4, show_default=True, type=click.IntRange(min=1), help='Number of issues whose comments are moved concurrently.')
+@click.option('-c', '--checkpoint', 'checkpoint_file', envvar='CHECKPOINT_FILE', default='.g2g_checkpoint', show_default=True, help='File used to resume an interrupted migration.')
+def cli(github_repo, gitlab_repo, github_access_token, gitlab_access_token, workers, checkpoint_file):
     """A simple python script for migrating issues from GitLab to GitHub."""
 
     click.echo()
@@ -18,6 +20,8 @@ def cli(github_repo, gitlab_repo, github_access_token, gitlab_access_token):
     click.secho("  > GitHub Repo: {}".format(github_repo))
     click.secho("  > GitLab Token: {}".format(gitlab_access_token))
     click.secho("  > GitHub Token: {}".format(github_access_token))
+    click.secho("  > Workers: {}".format(workers))
+    click.secho("  > Checkpoint: {}".format(checkpoint_file))
     click.echo()
 
     click.echo("Moving issues from '{}' to '{}'...".format(gitlab_repo, github_repo))
@@ -27,7 +31,7 @@ def cli(github_repo, gitlab_repo, github_access_token, gitlab_access_token):
     click.echo()
 
     start = timeit.default_timer()
-    github2gitlab(gitlab_repo, github_repo, gitlab_access_token, github_access_token)
+    github2gitlab(gitlab_repo, github_repo, gitlab_access_token, github_access_token, workers=workers, checkpoint_file=checkpoint_file)
     elapsed = timeit.default_timer() - start
 
     click.echo()
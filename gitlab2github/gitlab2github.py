@@ -1,13 +1,20 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import queue
 import functools
 import operator
+import random
 import json
+import sqlite3
 import time
 import re
 import os
 
+from requests.adapters import DEFAULT_POOLSIZE
+import requests
 import click
 from loguru import logger
-from github import Github
+from github import Github, GithubException, RateLimitExceededException
 from gitlab import Gitlab
 
 
@@ -15,77 +22,243 @@ uploads_pattern = re.compile("(/uploads/[^\s\)]+)")
 issues_pattern = re.compile("#([1-9][0-9]*)")
 merge_requests_pattern = re.compile("#([1-9][0-9]*)")
 
+# GitHub's secondary rate limit allows about 80 content creating requests per minute
+content_creation_interval = 1
 
-def slow_down(_func=None, *, rate=1):
-    """Sleep a given amount of seconds before calling the function."""
 
-    def decorator_slow_down(func):
-        @functools.wraps(func)
-        def wrapper_slow_down(*args, **kwargs):
-            time.sleep(rate)
-            return func(*args, **kwargs)
-        return wrapper_slow_down
+def prefetch(iterable, maxsize):
+    """Consume an iterable in a background thread, staying up to `maxsize` items ahead."""
 
-    if _func is None:
-        return decorator_slow_down
-    else:
-        return decorator_slow_down(_func)
+    items = queue.Queue(maxsize=maxsize)
+    done = object()
+
+    def producer():
+        try:
+            for item in iterable:
+                items.put((item, None))
+        except Exception as error:
+            items.put((None, error))
+        else:
+            items.put((done, None))
+
+    threading.Thread(target=producer, daemon=True).start()
+
+    while True:
+        item, error = items.get()
+
+        if error is not None:
+            raise error
+
+        if item is done:
+            return
+
+        yield item
+
+
+class RateLimiter:
+    """Space GitHub calls of all threads according to the rate limits."""
+
+    def __init__(self, github=None, threshold=100):
+        self.github = github
+        self.threshold = threshold
+        self.remaining = None
+        self.reset_at = None
+        self.blocked_until = 0
+        self.next_call = 0
+        self.lock = threading.Lock()
+
+    def block(self, timeout):
+        """Pause every thread for `timeout` seconds, e.g. after hitting a secondary rate limit."""
+
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.time() + timeout)
+
+    def acquire(self, interval=0):
+        """Wait for the next call slot shared by all threads.
+
+        Calls are spaced by at least `interval` seconds and, once the budget
+        runs low, the remaining requests are spread over the time left
+        until the reset.
+        """
+
+        with self.lock:
+            now = time.time()
+
+            spacing = interval
+            if self.remaining is not None and self.remaining < self.threshold:
+                spacing = max(spacing, max(0, self.reset_at - now) / max(self.remaining, 1))
+
+            start = max(now, self.blocked_until, self.next_call)
+            self.next_call = start + spacing
+
+        timeout = start - now
+        if timeout > 0:
+            logger.info("Rate limited, sleep for {:.2f} seconds.", timeout)
+
+            time.sleep(timeout)
+
+    def update(self):
+        """Read the rate limit reported by the last GitHub response."""
+
+        if self.github is None:
+            return
+
+        # Without a cached rate limit PyGithub fetches it, which mustn't hide the call's own error
+        try:
+            remaining, _ = self.github.rate_limiting
+            reset_at = self.github.rate_limiting_resettime
+        except Exception as error:
+            logger.error("Could not read the rate limit, keep the previous one.")
+            logger.error(error)
+            return
+
+        self.remaining = remaining
+        self.reset_at = reset_at
 
 
-def retry(_func=None, *, times=1, delay=0, forever=False):
-    """Retry the function a given amount of times."""
+rate_limiter = RateLimiter()
 
-    def decorator_retry(func):
+
+class Checkpoint:
+    """Remember what was already moved so an interrupted run can be resumed."""
+
+    def __init__(self, filename, namespace):
+        # Comments are checkpointed from the worker threads, access is serialized by the lock
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS checkpoint (key TEXT PRIMARY KEY, value INTEGER)")
+        self.connection.commit()
+        self.namespace = namespace
+        self.lock = threading.Lock()
+
+    def key(self, *parts):
+        return ":".join(str(part) for part in (self.namespace, *parts))
+
+    def get(self, *parts):
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM checkpoint WHERE key = ?", (self.key(*parts),)).fetchone()
+
+        return row[0] if row else None
+
+    def set(self, value, *parts):
+        with self.lock:
+            self.connection.execute("REPLACE INTO checkpoint (key, value) VALUES (?, ?)", (self.key(*parts), value))
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def rate_limit_timeout(error):
+    """Return how long to wait after a rate limited GitHub response, None if it wasn't."""
+
+    headers = error.headers or {}
+
+    if not (
+        error.status == 429
+        or isinstance(error, RateLimitExceededException)
+        or (error.status == 403 and "rate limit" in str(error.data).lower())
+    ):
+        return None
+
+    if "retry-after" in headers:
+        return int(headers["retry-after"])
+
+    if headers.get("x-ratelimit-remaining") == "0" and "x-ratelimit-reset" in headers:
+        return max(0, int(headers["x-ratelimit-reset"]) - time.time())
+
+    # GitHub asks to wait at least a minute when it doesn't say how long
+    return 60
+
+
+def api_call(_func=None, *, interval=0, backoff=1, max_backoff=600):
+    """Call the GitHub API within its rate limit, retrying rate limited and transient errors.
+
+    Calls are spaced by at least `interval` seconds across all threads.
+    """
+
+    def decorator_api_call(func):
         @functools.wraps(func)
-        def wrapper_retry(*args, **kwargs):
+        def wrapper_api_call(*args, **kwargs):
             attempt = 1
-            timeout = delay
-            while forever or attempt < times:
+            timeout = backoff
+            while True:
+                rate_limiter.acquire(interval)
                 try:
-                    logger.info("Attempt #{} for {!r}.", attempt, func)
                     return func(*args, **kwargs)
-                except Exception as error:
-                    logger.error("An error ocurred on attempt #{}.", attempt)
+                except GithubException as error:
+                    sleep = rate_limit_timeout(error)
+
+                    if sleep is None and error.status < 500:
+                        raise
+
+                    logger.error("An error ocurred on attempt #{} for {!r}.", attempt, func)
+                    logger.error(error)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+                    sleep = None
+
+                    logger.error("An error ocurred on attempt #{} for {!r}.", attempt, func)
                     logger.error(error)
+                finally:
+                    rate_limiter.update()
 
-                    attempt += 1
+                attempt += 1
 
-                    logger.info("Sleep for {} seconds.", timeout)
+                # Rate limited calls pause every thread until GitHub allows requests again
+                if sleep is not None:
+                    rate_limiter.block(sleep)
+                    continue
 
-                    time.sleep(timeout)
-                    timeout += 5 * 60
+                # Other errors back off exponentially
+                sleep = timeout + random.uniform(0, timeout * 0.1)
+                timeout = min(timeout * 2, max_backoff)
 
-                    if not forever and attempt == times:
-                        raise error
+                logger.info("Sleep for {:.2f} seconds.", sleep)
 
-        return wrapper_retry
+                time.sleep(sleep)
+
+        return wrapper_api_call
 
     if _func is None:
-        return decorator_retry
+        return decorator_api_call
     else:
-        return decorator_retry(_func)
+        return decorator_api_call(_func)
+
+
+@functools.lru_cache(maxsize=32)
+def mentions_pattern(usernames):
+    """Compile a pattern matching a mention of any of the given usernames."""
+
+    # Longer usernames first so "@john.doe" isn't matched as "@john"
+    usernames = sorted(usernames, key=len, reverse=True)
+
+    # Usernames may end with "-", so a word boundary can't mark their end
+    return re.compile(r"@({})(?![\w-])".format("|".join(re.escape(username) for username in usernames)))
 
 
 def fix_mentions(text, users):
-    for user in users:
-        text = text.replace(
-            "@{}".format(user["username"]),
-            "[@{}]({})".format(user["username"], user["web_url"])
-        )
+    if not users or "@" not in text:
+        return text
 
-    return text
+    web_urls = {user["username"]: user["web_url"] for user in users}
+    pattern = mentions_pattern(tuple(web_urls))
+
+    return pattern.sub(lambda match: "[@{}]({})".format(match.group(1), web_urls[match.group(1)]), text)
 
 
 def fix_upload_links(text, url):
-    return uploads_pattern.sub(r'{}\1'.format(url), text)
+    if "/uploads/" not in text:
+        return text
+
+    return uploads_pattern.sub(lambda match: url + match.group(1), text)
 
 
 def fix_issue_references(text, url):
-    return issues_pattern.sub(r'{}/-/issues/\1'.format(url), text)
+    return issues_pattern.sub(lambda match: "{}/-/issues/{}".format(url, match.group(1)), text)
 
 
 def fix_merge_requests_references(text, url):
-    return merge_requests_pattern.sub(r'{}/-/merge_requests/\1'.format(url), text)
+    return merge_requests_pattern.sub(lambda match: "{}/-/merge_requests/{}".format(url, match.group(1)), text)
 
 
 def fix_links(text, url):
@@ -121,8 +294,7 @@ def add_comment_footer(comment, url):
     )
 
 
-@retry(delay=60 * 20, forever=True)
-@slow_down(rate=15)
+@api_call(interval=content_creation_interval)
 def create_github_issue(project, title, description=None, labels=None):
     """Crate a GitHub issue."""
 
@@ -133,132 +305,243 @@ def create_github_issue(project, title, description=None, labels=None):
     )
 
 
-@retry(delay=60 * 20, forever=True)
-@slow_down(rate=15)
-def close_github_issue(issue):
-    """Close a GitHub issue."""
+@api_call
+def get_github_issue(project, number):
+    """Get an existing GitHub issue."""
+
+    return project.get_issue(number)
 
-    issue.edit(state='closed')
 
+@api_call(interval=content_creation_interval)
+def close_github_issues(project, issues):
+    """Close several GitHub issues with a single GraphQL request."""
 
-@retry(delay=60 * 20, forever=True)
-@slow_down(rate=15)
+    variables = {"issue{}".format(index): issue.node_id for index, issue in enumerate(issues)}
+    query = "mutation({}) {{ {} }}".format(
+        ", ".join("${}: ID!".format(name) for name in variables),
+        " ".join("{0}: closeIssue(input: {{issueId: ${0}}}) {{ clientMutationId }}".format(name) for name in variables),
+    )
+
+    project._requester.graphql_query(query, variables)
+
+
+@api_call(interval=content_creation_interval)
 def create_github_comment(issue, comment):
     """Leave a comment on a github issue."""
 
     return issue.create_comment(comment)
 
 
-@retry(delay=60 * 20, forever=True)
-@slow_down(rate=15)
+@api_call(interval=content_creation_interval)
 def create_github_label(project, name, description=None, color=None):
     """Create a new label."""
 
     logger.info("Create label '{}'.", name)
-
-    logger.debug("Name: {}", name)
-    logger.debug("Description: {}", description)
-    logger.debug("Color: {}", color)
+    logger.debug("Name: {}, description: {}, color: {}", name, description, color)
 
     project.create_label(name, color, description=description)
 
 
 def move_labels(gl_project, gh_project):
-    """Move labels from GitLab to GitLab."""
+    """Move labels from GitLab to GitLab.
+
+    Return the GitHub label name of every GitLab label.
+    """
 
-    gl_labels = {gl_label for gl_label in gl_project.labels.list(iterator=True)}
-    gh_labels = gh_project.get_labels()
+    gh_labels = {gh_label.name.lower() for gh_label in gh_project.get_labels()}
 
     # excluded_labels = ["Doing", "To Do", "In Code Review", "Testing"]
     excluded_labels = []
 
-    for gl_label in gl_labels:
-        if gl_label.name.lower() not in (gh_label.name for gh_label in gh_labels):
-            if gl_label.name in excluded_labels:
-                continue
+    label_titles = {}
 
-            logger.info("Move label '{}'.", gl_label.name)
-            click.echo("  * Move label '{}'".format(gl_label.name))
+    for gl_label in gl_project.labels.list(iterator=True, per_page=100):
+        title = gl_label.name.lower()
+        label_titles[gl_label.name] = title
 
-            title = gl_label.name.lower()
-            color = gl_label.color.replace("#", "") # GitHub expects the hex color without the "#"
-            description = gl_label.description[:100] if gl_label.description else "" # GitHub doesn't allow descriptions longer than 100 characters
+        if title in gh_labels or gl_label.name in excluded_labels:
+            continue
+
+        logger.info("Move label '{}'.", gl_label.name)
+        click.echo("  * Move label '{}'".format(gl_label.name))
+
+        color = gl_label.color.replace("#", "") # GitHub expects the hex color without the "#"
+        description = gl_label.description[:100] if gl_label.description else "" # GitHub doesn't allow descriptions longer than 100 characters
 
-            create_github_label(gh_project, title, description=description, color=color)
+        create_github_label(gh_project, title, description=description, color=color)
+        gh_labels.add(title)
 
-    if "gitlab" not in (gh_label.name for gh_label in gh_labels):
+    if "gitlab" not in gh_labels:
         create_github_label(
             gh_project, "gitlab",
             description="For issues moved from GitLab",
             color="FC6D27"
         )
+        gh_labels.add("gitlab")
 
+    return label_titles
 
-def move_comments(gl_project, gl_issue, gh_issue):
+
+def move_comments(gl_project, gl_issue, gh_issue, notes, participants, checkpoint):
     """Move issue comments from GitLab to GitLab."""
 
-    for note in sorted(gl_issue.notes.list(iterator=True), key=operator.attrgetter('created_at')):
+    comments = []
+
+    for note in notes:
         # Skip private comments
         if note.confidential:
             continue
 
-        if not note.system:
-            logger.info("Move comment '{}'.", note.id)
-            click.echo("    * Move comment {}".format(note.id))
+        # Skip comments moved by a previous run
+        if checkpoint.get(gl_issue.iid, note.id):
+            continue
 
+        if not note.system:
             comment = fix_links(note.body, gl_project.web_url)
-            comment = fix_mentions(comment, gl_issue.participants())
+            comment = fix_mentions(comment, participants)
             comment = add_comment_footer(comment, "{}#note_{}".format(gl_issue.web_url, note.id))
 
-            create_github_comment(gh_issue, comment)
+            comments.append((note.id, comment))
+
+    # Comments of the same issue are posted in order, GitHub sorts them by creation time
+    for note_id, comment in comments:
+        logger.info("Move comment '{}'.", note_id)
+        click.echo("    * Move comment {}".format(note_id))
+
+        create_github_comment(gh_issue, comment)
+        checkpoint.set(True, gl_issue.iid, note_id)
+
+
+def close_issues(gh_project, gh_issues, batch_size=25):
+    """Close GitHub issues in batches."""
 
+    for start in range(0, len(gh_issues), batch_size):
+        batch = gh_issues[start:start + batch_size]
 
-def move_issues(gl_project, gh_project):
-    """Move issues form GitLab to GitHub."""
+        logger.info("Close {} issues.", len(batch))
+        click.echo("  * Close issues {}".format(", ".join("#{}".format(gh_issue.number) for gh_issue in batch)))
 
-    for gl_issue in sorted(gl_project.issues.list(iterator=True), key=operator.attrgetter('iid')):
+        close_github_issues(gh_project, batch)
+
+
+def prepare_issues(gl_project):
+    """Yield the GitLab issues to move with their notes, participants and GitHub description."""
+
+    # GitLab can't order issues by iid and imported projects may have created_at out of
+    # iid order, so issues are sorted here to keep the GitHub numbering in iid order
+    gl_issues = sorted(gl_project.issues.list(iterator=True, per_page=100), key=operator.attrgetter('iid'))
+
+    for gl_issue in gl_issues:
 
         # Skip private issues
         if gl_issue.confidential:
             continue
-        
+
         # if gl_issue.state == 'closed':
         #     continue
-        
+
         # if gl_issue.iid <= 170:
         #     continue
 
-        logger.info("Move issue #{}.", gl_issue.iid)
-        click.echo("  * Move issue #{}".format(gl_issue.iid))
+        notes = sorted(gl_issue.notes.list(iterator=True), key=operator.attrgetter('created_at'))
+        participants = gl_issue.participants()
 
         issue_description = gl_issue.description or ""
         issue_description = fix_links(issue_description, gl_project.web_url)
-        issue_description = fix_mentions(issue_description, gl_issue.participants())
+        issue_description = fix_mentions(issue_description, participants)
         issue_description = add_issue_footer(issue_description, gl_issue.web_url)
 
-        gh_issue = create_github_issue(
-            gh_project,
-            gl_issue.title,
-            description=issue_description,
-            labels=[*[gl_label.lower() for gl_label in gl_issue.labels], 'gitlab']
-        )
-        logger.info("New issue #{} created.", gh_issue.number)
+        yield gl_issue, notes, participants, issue_description
+
+
+def move_issues(gl_project, gh_project, label_titles, checkpoint, workers=4):
+    """Move issues form GitLab to GitHub.
+
+    GitLab issues and their notes are fetched in a background thread while
+    issues are created one by one to keep their order, their comments are
+    moved by a pool of `workers` threads and closed issues are closed at
+    the end in batches.
+    """
+
+    to_close = []
+
+    # Issue creation may only run a few issues ahead of their comments
+    pending = threading.BoundedSemaphore(workers * 2)
 
-        if gl_issue.state == 'closed':
-            close_github_issue(gh_issue)
+    def move_pending_comments(*args):
+        try:
+            move_comments(*args)
+        finally:
+            pending.release()
 
-        move_comments(gl_project, gl_issue, gh_issue)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    futures = []
 
+    try:
+        for gl_issue, notes, participants, issue_description in prefetch(prepare_issues(gl_project), maxsize=4):
+            pending.acquire()
 
-def github2gitlab(gitlab_repo, github_repo, gitlab_access_token, github_access_token):
+            # Raise errors of workers that already finished
+            for future in [future for future in futures if future.done()]:
+                futures.remove(future)
+                future.result()
+
+            gh_issue_number = checkpoint.get(gl_issue.iid)
+
+            if gh_issue_number is not None:
+                # Issue moved by a previous run, only its remaining comments are moved
+                logger.info("Resume issue #{}.", gl_issue.iid)
+                click.echo("  * Resume issue #{}".format(gl_issue.iid))
+
+                gh_issue = get_github_issue(gh_project, gh_issue_number)
+            else:
+                logger.info("Move issue #{}.", gl_issue.iid)
+                click.echo("  * Move issue #{}".format(gl_issue.iid))
+
+                gh_issue = create_github_issue(
+                    gh_project,
+                    gl_issue.title,
+                    description=issue_description,
+                    labels=[*[label_titles.get(gl_label, gl_label.lower()) for gl_label in gl_issue.labels], 'gitlab']
+                )
+                checkpoint.set(gh_issue.number, gl_issue.iid)
+                logger.info("New issue #{} created.", gh_issue.number)
+
+            if gl_issue.state == 'closed':
+                to_close.append(gh_issue)
+
+            futures.append(executor.submit(move_pending_comments, gl_project, gl_issue, gh_issue, notes, participants, checkpoint))
+
+        for future in futures:
+            future.result()
+    except BaseException:
+        # Don't post the comments of queued issues when interrupted, the checkpoint resumes them
+        executor.shutdown(cancel_futures=True)
+        raise
+
+    executor.shutdown()
+
+    close_issues(gh_project, to_close)
+
+
+def github2gitlab(gitlab_repo, github_repo, gitlab_access_token, github_access_token, workers=4, checkpoint_file=".g2g_checkpoint"):
     """Move labels, issues and comments from GitLab to GitHub."""
 
+    # GitHub is called by the workers and the main thread, never shrink below the requests default
+    pool_size = max(workers + 1, DEFAULT_POOLSIZE)
+
     gl = Gitlab(private_token=gitlab_access_token)
-    gh = Github(github_access_token)
+    # Retries are left to api_call, PyGithub's own retry would raise RetryError once exhausted
+    gh = Github(github_access_token, pool_size=pool_size, retry=None)
+    rate_limiter.github = gh
     print(gh.get_rate_limit())
     gl_project = gl.projects.get(gitlab_repo)
     gh_project = gh.get_repo(github_repo)
 
-    move_labels(gl_project, gh_project)
-    move_issues(gl_project, gh_project)
+    label_titles = move_labels(gl_project, gh_project)
+    checkpoint = Checkpoint(checkpoint_file, "{}:{}".format(gitlab_repo, github_repo))
+    try:
+        move_issues(gl_project, gh_project, label_titles, checkpoint, workers=workers)
+    finally:
+        checkpoint.close()
     print(gh.get_rate_limit())